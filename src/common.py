@@ -0,0 +1,94 @@
+import pandas as pd
+import numpy as np
+import folium
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count, get_all_start_methods, get_context
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# 需要转换为数值的水质指标
+NUMERIC_COLS = ['入河废污水量(万吨年)', '入河主要污染物量（吨年）', '氨氮入河量（吨年）', '总磷入河量（吨年）', '总氮入河量（吨年）']
+
+def load_data(path):
+    """读取Excel数据，并在同目录下缓存为feather文件"""
+    cache_path = f'{path}.feather'
+    # 缓存比原始Excel新时直接读取缓存
+    if os.path.exists(cache_path) and os.stat(cache_path).st_mtime >= os.stat(path).st_mtime:
+        return pd.read_feather(cache_path, dtype_backend='pyarrow')
+    
+    data = pd.read_excel(path, engine='openpyxl', dtype_backend='pyarrow')
+    # 混合类型的列统一转为字符串，便于写入feather
+    object_cols = data.select_dtypes(include='object').columns
+    data[object_cols] = data[object_cols].astype('string[pyarrow]')
+    data.to_feather(cache_path)
+    # 从缓存读回，保证首次运行与命中缓存时的列类型一致
+    return pd.read_feather(cache_path, dtype_backend='pyarrow')
+
+def base_map():
+    """创建两份报告共用的底图，图层由调用方以FeatureGroup添加"""
+    return folium.Map(location=[34, 111], zoom_start=7)
+
+def points_geojson(data, fields):
+    """将带经纬度的记录转换为GeoJSON点要素集合，fields为 {属性名: 列名}"""
+    coords = data[['经度', '纬度']].to_numpy(dtype=np.float64).tolist()
+    props = data[list(fields.values())].astype(object)
+    props = props.where(props.notna(), None).set_axis(list(fields), axis=1).to_dict('records')
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': c}, 'properties': p}
+            for c, p in zip(coords, props)
+        ]
+    }
+
+def new_fig(figsize):
+    """创建不注册到pyplot的Figure及其坐标轴"""
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot(111)
+
+def _render_png(fig_bytes, path, savefig_kwargs):
+    """在子进程中渲染并保存图像"""
+    fig = pickle.loads(fig_bytes)
+    FigureCanvasAgg(fig)
+    fig.savefig(path, **savefig_kwargs)
+
+class AsyncPlotter:
+    """使用进程池并行保存matplotlib图像"""
+    def __init__(self, max_workers=None):
+        # fork模式下进程池会一次性启动全部工作进程，报告图像不多，限制进程数
+        self.max_workers = max_workers or min(cpu_count(), 4)
+        self._executor = None
+        self._futures = []
+    
+    def start(self):
+        """创建进程池并启动工作进程，之后再运行多线程计算"""
+        if self._executor is not None:
+            return
+        # macOS默认使用spawn，优先使用fork避免重新导入模块。
+        # fork只复制调用线程，在多线程进程（如DBSCAN(n_jobs=-1)运行之后）中fork不安全，
+        # 因此调用方应在启动多线程计算之前调用本方法
+        mp_context = get_context('fork') if 'fork' in get_all_start_methods() else None
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=mp_context)
+        # fork模式下首次提交任务时一次性创建全部工作进程
+        self._executor.submit(int).result()
+    
+    def save(self, fig, path, **savefig_kwargs):
+        """提交保存任务，图像在主进程中序列化"""
+        fig_bytes = pickle.dumps(fig)
+        self.start()
+        self._futures.append(self._executor.submit(_render_png, fig_bytes, path, savefig_kwargs))
+    
+    def join(self):
+        """等待所有保存任务完成并关闭进程池"""
+        if self._executor is None:
+            return
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._futures = []
+            self._executor.shutdown()
+            self._executor = None
@@ -1,17 +1,32 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib
 import seaborn as sns
 import folium
 import os
 from datetime import datetime
-plt.rcParams['font.sans-serif'] = ['Arial Unicode MS']  # 设置中文字体
+from common import NUMERIC_COLS, AsyncPlotter, base_map, load_data, new_fig, points_geojson
+matplotlib.rcParams['font.sans-serif'] = ['Arial Unicode MS']  # 设置中文字体
+
+# 报告中需要统计取值分布的分类字段
+_CATEGORICAL_COLS = ['排污口类型名称', '污水性质', '污水入河方式']
+
+def _rotate_xticks(ax):
+    """x轴刻度标签旋转45度并右对齐"""
+    for label in ax.get_xticklabels():
+        label.set(rotation=45, ha='right')
 
 class DataAnalyzer:
-    def __init__(self, data_path):
-        self.data = pd.read_excel(data_path)
+    def __init__(self, data):
+        # 支持传入文件路径或已加载的DataFrame
+        if isinstance(data, pd.DataFrame):
+            self.data = data.copy(deep=False)
+        else:
+            self.data = load_data(data)
         self.report_dir = 'reports'
         self.images_dir = f'{self.report_dir}/images'
+        self._plotter = AsyncPlotter()
+        self._vcs = None
         
         # 创建必要的目录
         os.makedirs(self.report_dir, exist_ok=True)
@@ -22,16 +37,16 @@ class DataAnalyzer:
         
     def preprocess_data(self):
         """数据预处理"""
-        # 转换数据类型
-        numeric_cols = ['入河废污水量(万吨年)', '入河主要污染物量（吨年）', '氨氮入河量（吨年）', '总磷入河量（吨年）', '总氮入河量（吨年）']
-        for col in numeric_cols:
-            if col in self.data.columns:
-                self.data[col] = pd.to_numeric(self.data[col], errors='coerce')
-        
-        # 处理经纬度数据
-        self.data['经度'] = pd.to_numeric(self.data['经度'], errors='coerce')
-        self.data['纬度'] = pd.to_numeric(self.data['纬度'], errors='coerce')
+        # 转换数据类型（水质指标和经纬度一次性转换）
+        self._numeric_cols = [col for col in NUMERIC_COLS if col in self.data.columns]
+        cols = self._numeric_cols + ['经度', '纬度']
+        # 先转为object再解析，Arrow字符串列直接to_numeric会得到错误结果；解析后统一转为Arrow浮点列
+        self.data[cols] = self.data[cols].astype(object).apply(pd.to_numeric, errors='coerce').astype('double[pyarrow]')
         
+    def join_plots(self):
+        """等待后台保存的图像全部写入"""
+        self._plotter.join()
+    
     def basic_info(self):
         """数据基本信息分析"""
         info = {
@@ -43,20 +58,20 @@ class DataAnalyzer:
         return info
     
     def missing_analysis(self):
-        """缺失值分析"""
-        missing = self.data.isnull().sum()
+        """缺失值分析（图像在后台保存，需调用join_plots()等待写入完成）"""
+        # Arrow列的缺失统计直接基于有效位图计算
+        missing = self.data.isna().sum(axis=0)
         missing_percent = (missing / len(self.data)) * 100
         
         # 生成缺失值可视化
-        plt.figure(figsize=(12, 6))
-        missing_percent.plot(kind='bar')
-        plt.title('数据缺失率分析')
-        plt.xlabel('字段名')
-        plt.ylabel('缺失率 (%)')
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-        plt.savefig(f'{self.images_dir}/missing_analysis.png')
-        plt.close()
+        fig, ax = new_fig((12, 6))
+        missing_percent.plot(kind='bar', ax=ax)
+        ax.set_title('数据缺失率分析')
+        ax.set_xlabel('字段名')
+        ax.set_ylabel('缺失率 (%)')
+        _rotate_xticks(ax)
+        fig.tight_layout()
+        self._plotter.save(fig, f'{self.images_dir}/missing_analysis.png')
         
         return pd.DataFrame({
             'missing_count': missing,
@@ -64,69 +79,64 @@ class DataAnalyzer:
         })
     
     def outlier_analysis(self):
-        """异常值分析"""
-        numeric_cols = ['入河废污水量(万吨年)', '入河主要污染物量（吨年）', '氨氮入河量（吨年）', '总磷入河量（吨年）', '总氮入河量（吨年）']
-        outliers = {}
-        
+        """异常值分析（图像在后台保存，需调用join_plots()等待写入完成）"""
         # 生成箱线图
-        plt.figure(figsize=(12, 6))
-        valid_cols = [col for col in numeric_cols if col in self.data.columns]
-        self.data[valid_cols].boxplot()
-        plt.title('水质指标箱线图')
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-        plt.savefig(f'{self.images_dir}/outliers_boxplot.png')
-        plt.close()
+        fig, ax = new_fig((12, 6))
+        self.data[self._numeric_cols].boxplot(ax=ax)
+        ax.set_title('水质指标箱线图')
+        _rotate_xticks(ax)
+        fig.tight_layout()
+        self._plotter.save(fig, f'{self.images_dir}/outliers_boxplot.png')
         
-        for col in numeric_cols:
-            if col in self.data.columns:
-                Q1 = self.data[col].quantile(0.25)
-                Q3 = self.data[col].quantile(0.75)
-                IQR = Q3 - Q1
-                outliers[col] = self.data[
-                    (self.data[col] < (Q1 - 1.5 * IQR)) | 
-                    (self.data[col] > (Q3 + 1.5 * IQR))
-                ].shape[0]
-        return outliers
+        # 一次性计算各列四分位数，按IQR规则统计异常值
+        arr = self.data[self._numeric_cols].to_numpy(dtype=np.float64, na_value=np.nan)
+        q = np.nanpercentile(arr, [25, 75], axis=0)
+        iqr = q[1] - q[0]
+        lo, hi = q[0] - 1.5 * iqr, q[1] + 1.5 * iqr
+        counts = ((arr < lo) | (arr > hi)).sum(axis=0)
+        return dict(zip(self._numeric_cols, counts.tolist()))
+    
+    def _value_counts(self):
+        """各分类字段的取值计数，首次调用时计算并缓存"""
+        if self._vcs is None:
+            self._vcs = {col: self.data[col].value_counts() for col in _CATEGORICAL_COLS}
+        return self._vcs
     
     def generate_statistics(self):
-        """生成统计表格"""
+        """生成统计表格（图像在后台保存，需调用join_plots()等待写入完成）"""
         # 表1: 省际分布
         province_dist = self.data.groupby('省份').size().reset_index(name='数量')
         
         # 生成省际分布饼图
-        plt.figure(figsize=(8, 8))
-        plt.pie(province_dist['数量'], labels=province_dist['省份'], autopct='%1.1f%%')
-        plt.title('排污口省际分布')
-        plt.savefig(f'{self.images_dir}/province_dist.png')
-        plt.close()
+        fig, ax = new_fig((8, 8))
+        ax.pie(province_dist['数量'], labels=province_dist['省份'], autopct='%1.1f%%')
+        ax.set_title('排污口省际分布')
+        self._plotter.save(fig, f'{self.images_dir}/province_dist.png')
         
         # 表2: 排口类型统计
-        type_dist = self.data['排污口类型名称'].value_counts().reset_index()
+        type_dist = self._value_counts()['排污口类型名称'].reset_index()
         type_dist.columns = ['类型', '数量']
         
         # 生成排口类型柱状图
-        plt.figure(figsize=(10, 6))
-        plt.bar(type_dist['类型'], type_dist['数量'])
-        plt.title('排污口类型分布')
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-        plt.savefig(f'{self.images_dir}/type_dist.png')
-        plt.close()
+        fig, ax = new_fig((10, 6))
+        ax.bar(type_dist['类型'], type_dist['数量'])
+        ax.set_title('排污口类型分布')
+        _rotate_xticks(ax)
+        fig.tight_layout()
+        self._plotter.save(fig, f'{self.images_dir}/type_dist.png')
         
         # 表3: 排放特征统计
-        feature_dist = self.data['污水性质'].value_counts().reset_index()
+        feature_dist = self._value_counts()['污水性质'].reset_index()
         feature_dist.columns = ['特征', '数量']
         
         # 生成排放特征饼图
-        plt.figure(figsize=(8, 8))
-        plt.pie(feature_dist['数量'], labels=feature_dist['特征'], autopct='%1.1f%%')
-        plt.title('排放特征分布')
-        plt.savefig(f'{self.images_dir}/feature_dist.png')
-        plt.close()
+        fig, ax = new_fig((8, 8))
+        ax.pie(feature_dist['数量'], labels=feature_dist['特征'], autopct='%1.1f%%')
+        ax.set_title('排放特征分布')
+        self._plotter.save(fig, f'{self.images_dir}/feature_dist.png')
         
         # 表4: 入河方式统计
-        discharge_dist = self.data['污水入河方式'].value_counts().reset_index()
+        discharge_dist = self._value_counts()['污水入河方式'].reset_index()
         discharge_dist.columns = ['方式', '数量']
         
         return {
@@ -147,14 +157,16 @@ class DataAnalyzer:
                 return
             
             # 创建地图
-            m = folium.Map(location=[34, 111], zoom_start=7)
+            m = base_map()
             
-            # 添加排污口标记
-            for _, row in map_data.iterrows():
-                folium.Marker(
-                    location=[row['纬度'], row['经度']],
-                    popup=f"名称: {row['入河排污口名称']}<br>类型: {row['排污口类型名称']}<br>特征: {row['污水性质']}"
-                ).add_to(m)
+            # 添加排污口标记，所有点作为一个GeoJSON图层在浏览器端渲染
+            outlets = folium.FeatureGroup(name='排污口')
+            fields = {'name': '入河排污口名称', 'type': '排污口类型名称', 'feature': '污水性质'}
+            folium.GeoJson(
+                points_geojson(map_data, fields),
+                popup=folium.GeoJsonPopup(fields=list(fields), aliases=['名称', '类型', '特征'])
+            ).add_to(outlets)
+            outlets.add_to(m)
             
             # 保存地图
             m.save(f'{self.images_dir}/pollution_map.html')
@@ -163,81 +175,88 @@ class DataAnalyzer:
     
     def generate_report(self):
         """生成分析报告"""
-        # 生成地图
-        self.generate_map()
-            
-        with open(f'{self.report_dir}/analysis_report.md', 'w', encoding='utf-8') as f:
-            f.write('# 南水北调中线水源区排污口数据分析报告\n\n')
-            
-            # 基本信息
-            f.write('## 1. 数据基本信息\n\n')
-            f.write(f'数据维度: {self.data.shape}\n\n')
-            f.write('数据列名:\n')
-            for col in self.data.columns:
-                f.write(f'- {col}\n')
-            
-            # 缺失值分析
-            f.write('\n## 2. 缺失值分析\n\n')
-            missing_df = self.missing_analysis()
-            f.write(missing_df.to_markdown())
-            f.write('\n\n![缺失值分析](images/missing_analysis.png)\n')
-            
-            # 异常值分析
-            f.write('\n## 3. 异常值分析\n\n')
-            outliers = self.outlier_analysis()
-            for col, count in outliers.items():
-                f.write(f'- {col}: {count}个异常值\n')
-            f.write('\n\n![异常值分析](images/outliers_boxplot.png)\n')
-            
-            # 统计结果
-            f.write('\n## 4. 统计结果\n\n')
-            stats = self.generate_statistics()
-            
-            # 省际分布
-            f.write('### 4.1 省际分布\n\n')
-            f.write(stats['province_dist'].to_markdown(index=False))
-            f.write('\n\n![省际分布](images/province_dist.png)\n')
-            
-            # 排口类型
-            f.write('\n### 4.2 排口类型统计\n\n')
-            f.write(stats['type_dist'].to_markdown(index=False))
-            f.write('\n\n![排口类型分布](images/type_dist.png)\n')
-            
-            # 排放特征
-            f.write('\n### 4.3 排放特征统计\n\n')
-            f.write(stats['feature_dist'].to_markdown(index=False))
-            f.write('\n\n![排放特征分布](images/feature_dist.png)\n')
-            
-            # 入河方式
-            f.write('\n### 4.4 入河方式统计\n\n')
-            f.write(stats['discharge_dist'].to_markdown(index=False))
-            
-            # 冷却水排放情况
-            f.write('\n### 4.5 冷却水排放情况\n\n')
-            cooling_water = self.data[self.data['污水性质'].str.contains('冷却水', na=False)]
-            if not cooling_water.empty:
-                f.write(f'冷却水排放口数量: {len(cooling_water)}\n\n')
-                f.write('按省份分布:\n')
-                f.write(cooling_water['省份'].value_counts().to_markdown())
-            else:
-                f.write('未发现冷却水排放口\n')
-            
-            # 数据质量评估
-            f.write('\n## 5. 数据质量评估\n\n')
-            f.write('### 5.1 数据完整性\n\n')
-            f.write('- 基本信息（省、市、县、排污口名称等）完整性较好\n')
-            f.write('- 水质指标（COD、氨氮、总磷等）数据缺失严重\n')
-            f.write('- 地理位置信息部分缺失\n\n')
-            
-            f.write('### 5.2 数据准确性\n\n')
-            f.write('- 经纬度数据存在格式问题，需要进一步清洗\n')
-            f.write('- 入河方式数据可能存在异常值\n\n')
-            
-            f.write('### 5.3 建议\n\n')
-            f.write('1. 补充水质监测数据\n')
-            f.write('2. 完善地理位置信息\n')
-            f.write('3. 规范入河方式数据格式\n')
+        try:
+            # 生成地图
+            self.generate_map()
+                
+            with open(f'{self.report_dir}/analysis_report.md', 'w', encoding='utf-8') as f:
+                f.write('# 南水北调中线水源区排污口数据分析报告\n\n')
+                
+                # 基本信息
+                f.write('## 1. 数据基本信息\n\n')
+                f.write(f'数据维度: {self.data.shape}\n\n')
+                f.write('数据列名:\n')
+                for col in self.data.columns:
+                    f.write(f'- {col}\n')
+                
+                # 缺失值分析
+                f.write('\n## 2. 缺失值分析\n\n')
+                missing_df = self.missing_analysis()
+                missing_df.to_markdown(buf=f)
+                f.write('\n\n![缺失值分析](images/missing_analysis.png)\n')
+                
+                # 异常值分析
+                f.write('\n## 3. 异常值分析\n\n')
+                outliers = self.outlier_analysis()
+                for col, count in outliers.items():
+                    f.write(f'- {col}: {count}个异常值\n')
+                f.write('\n\n![异常值分析](images/outliers_boxplot.png)\n')
+                
+                # 统计结果
+                f.write('\n## 4. 统计结果\n\n')
+                stats = self.generate_statistics()
+                
+                # 省际分布
+                f.write('### 4.1 省际分布\n\n')
+                stats['province_dist'].to_markdown(buf=f, index=False)
+                f.write('\n\n![省际分布](images/province_dist.png)\n')
+                
+                # 排口类型
+                f.write('\n### 4.2 排口类型统计\n\n')
+                stats['type_dist'].to_markdown(buf=f, index=False)
+                f.write('\n\n![排口类型分布](images/type_dist.png)\n')
+                
+                # 排放特征
+                f.write('\n### 4.3 排放特征统计\n\n')
+                stats['feature_dist'].to_markdown(buf=f, index=False)
+                f.write('\n\n![排放特征分布](images/feature_dist.png)\n')
+                
+                # 入河方式
+                f.write('\n### 4.4 入河方式统计\n\n')
+                stats['discharge_dist'].to_markdown(buf=f, index=False)
+                
+                # 冷却水排放情况
+                f.write('\n### 4.5 冷却水排放情况\n\n')
+                # 只在去重后的污水性质取值上做子串匹配，再按取值筛选记录
+                features = self._value_counts()['污水性质'].index
+                cooling_features = features[features.str.contains('冷却水', regex=False, na=False)]
+                cooling_water = self.data[self.data['污水性质'].isin(cooling_features)]
+                if not cooling_water.empty:
+                    f.write(f'冷却水排放口数量: {len(cooling_water)}\n\n')
+                    f.write('按省份分布:\n')
+                    cooling_water['省份'].value_counts().to_markdown(buf=f)
+                else:
+                    f.write('未发现冷却水排放口\n')
+                
+                # 数据质量评估
+                f.write('\n## 5. 数据质量评估\n\n')
+                f.write('### 5.1 数据完整性\n\n')
+                f.write('- 基本信息（省、市、县、排污口名称等）完整性较好\n')
+                f.write('- 水质指标（COD、氨氮、总磷等）数据缺失严重\n')
+                f.write('- 地理位置信息部分缺失\n\n')
+                
+                f.write('### 5.2 数据准确性\n\n')
+                f.write('- 经纬度数据存在格式问题，需要进一步清洗\n')
+                f.write('- 入河方式数据可能存在异常值\n\n')
+                
+                f.write('### 5.3 建议\n\n')
+                f.write('1. 补充水质监测数据\n')
+                f.write('2. 完善地理位置信息\n')
+                f.write('3. 规范入河方式数据格式\n')
+        finally:
+            # 等待图像保存完成；出错时也关闭进程池，避免工作进程残留
+            self.join_plots()
 
 if __name__ == '__main__':
     analyzer = DataAnalyzer('南水北调中线水源区排污口.xlsx')
-    analyzer.generate_report() 
\ No newline at end of file
+    analyzer.generate_report()
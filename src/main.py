@@ -0,0 +1,14 @@
+from common import load_data
+from data_analysis import DataAnalyzer
+from pollution_trace import PollutionTracer
+
+def main(data_path='南水北调中线水源区排污口.xlsx'):
+    """只读取一次数据，依次生成数据分析报告和溯源报告"""
+    data = load_data(data_path)
+    analyzer = DataAnalyzer(data)
+    analyzer.generate_report()
+    tracer = PollutionTracer(data)
+    tracer.generate_trace_report()
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,38 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib
+from matplotlib.lines import Line2D
 import folium
 from sklearn.cluster import DBSCAN
-from sklearn.preprocessing import StandardScaler
 import os
 import markdown
 from docx import Document
 from docx.shared import Inches, Pt, RGBColor
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.oxml.ns import qn
+from common import NUMERIC_COLS, AsyncPlotter, base_map, load_data, new_fig, points_geojson
 
 # 设置中文字体
-plt.rcParams['font.sans-serif'] = ['Arial Unicode MS', 'SimHei', 'Microsoft YaHei']  # 优先使用系统支持的中文字体
-plt.rcParams['axes.unicode_minus'] = False  # 解决负号显示问题
+matplotlib.rcParams['font.sans-serif'] = ['Arial Unicode MS', 'SimHei', 'Microsoft YaHei']  # 优先使用系统支持的中文字体
+matplotlib.rcParams['axes.unicode_minus'] = False  # 解决负号显示问题
+
+# DBSCAN邻域半径（公里）
+EPS_KM = 5.0
+EARTH_RADIUS_KM = 6371.0
+
+# 计入总污染物排放量的指标
+_POL_COLS = ['入河主要污染物量（吨年）', '氨氮入河量（吨年）', 
+             '总磷入河量（吨年）', '总氮入河量（吨年）']
 
 class PollutionTracer:
-    def __init__(self, data_path):
-        self.data = pd.read_excel(data_path)
+    def __init__(self, data):
+        # 支持传入文件路径或已加载的DataFrame
+        if isinstance(data, pd.DataFrame):
+            self.data = data.copy(deep=False)
+        else:
+            self.data = load_data(data)
         self.output_dir = 'reports/trace'
+        self._plotter = AsyncPlotter()
         os.makedirs(self.output_dir, exist_ok=True)
         
         # 数据预处理
@@ -26,24 +40,22 @@ class PollutionTracer:
     
     def preprocess_data(self):
         """数据预处理"""
-        # 处理经纬度数据
-        self.data['经度'] = pd.to_numeric(self.data['经度'], errors='coerce')
-        self.data['纬度'] = pd.to_numeric(self.data['纬度'], errors='coerce')
+        # 处理经纬度和污染物数据
+        cols = ['经度', '纬度'] + NUMERIC_COLS
+        # 先转为object再解析，解析后统一转为Arrow浮点列
+        self.data[cols] = self.data[cols].astype(object).apply(pd.to_numeric, errors='coerce').astype('double[pyarrow]')
         
-        # 处理污染物数据
-        pollution_cols = ['入河废污水量(万吨年)', '入河主要污染物量（吨年）', 
-                        '氨氮入河量（吨年）', '总磷入河量（吨年）', '总氮入河量（吨年）']
-        for col in pollution_cols:
-            self.data[col] = pd.to_numeric(self.data[col], errors='coerce')
+        # 污染物指标转为连续的单精度数组，供汇总计算使用
+        self._pol_block = self.data[_POL_COLS].to_numpy(dtype=np.float32, na_value=np.nan)
     
     def spatial_clustering(self):
         """空间聚类分析"""
         # 准备数据
-        coords = self.data[['经度', '纬度']].values
-        coords = StandardScaler().fit_transform(coords)
+        coords = np.radians(self.data[['纬度', '经度']].to_numpy(dtype=np.float64, na_value=np.nan))
         
-        # 使用DBSCAN进行聚类
-        dbscan = DBSCAN(eps=0.3, min_samples=3)
+        # 使用DBSCAN进行聚类，按球面距离（haversine）在球树上做邻域查询
+        dbscan = DBSCAN(eps=EPS_KM / EARTH_RADIUS_KM, min_samples=3, metric='haversine',
+                        algorithm='ball_tree', n_jobs=-1)
         clusters = dbscan.fit_predict(coords)
         self.data['cluster'] = clusters
         
@@ -52,10 +64,7 @@ class PollutionTracer:
     def pollution_analysis(self):
         """污染物排放分析"""
         # 计算每个企业的总污染物排放量
-        self.data['total_pollution'] = self.data[
-            ['入河主要污染物量（吨年）', '氨氮入河量（吨年）', 
-             '总磷入河量（吨年）', '总氮入河量（吨年）']
-        ].sum(axis=1)
+        self.data['total_pollution'] = np.nansum(self._pol_block, axis=1)
         
         # 按企业分组统计
         company_stats = self.data.groupby('设置单位名称').agg({
@@ -71,53 +80,61 @@ class PollutionTracer:
     
     def generate_trace_report(self):
         """生成溯源报告"""
-        # 进行空间聚类
-        clusters = self.spatial_clustering()
-        
-        # 进行污染物分析
-        company_stats = self.pollution_analysis()
-        
-        # 生成报告
-        with open(f'{self.output_dir}/trace_report.md', 'w', encoding='utf-8') as f:
-            f.write('# 南水北调中线水源区污染源溯源分析报告\n\n')
-            
-            # 主要污染源分析
-            f.write('## 1. 主要污染源分析\n\n')
-            f.write('### 1.1 污染物排放量排名前10的企业\n\n')
-            f.write(company_stats.head(10).to_markdown(index=False))
-            f.write('\n\n')
+        # 在聚类启动多线程计算之前创建绘图进程池，避免在多线程进程中fork
+        self._plotter.start()
+        try:
+            # 进行空间聚类
+            self.spatial_clustering()
             
-            # 空间聚类分析
-            f.write('## 2. 污染源空间分布分析\n\n')
-            cluster_info = self.data.groupby('cluster').agg({
-                '设置单位名称': 'count',
-                'total_pollution': 'sum'
-            }).reset_index()
+            # 进行污染物分析
+            company_stats = self.pollution_analysis()
             
-            f.write('### 2.1 污染源聚集区统计\n\n')
-            f.write(cluster_info.to_markdown(index=False))
-            f.write('\n\n')
+            # 按聚集区一次性分组，供报告和可视化复用
+            self._groups = {cid: sub for cid, sub in self.data.groupby('cluster')}
             
-            # 详细聚类信息
-            f.write('### 2.2 各聚集区详细信息\n\n')
-            for cluster_id in np.unique(clusters):
-                if cluster_id == -1:  # 噪声点
-                    continue
-                    
-                cluster_data = self.data[self.data['cluster'] == cluster_id]
-                f.write(f'#### 聚集区 {cluster_id}\n\n')
-                f.write(f'- 企业数量: {len(cluster_data)}\n')
-                f.write(f'- 总污染物排放量: {cluster_data["total_pollution"].sum():.2f} 吨/年\n')
-                f.write('- 主要企业:\n')
+            # 生成报告
+            with open(f'{self.output_dir}/trace_report.md', 'w', encoding='utf-8') as f:
+                f.write('# 南水北调中线水源区污染源溯源分析报告\n\n')
                 
-                # 按污染物排放量排序
-                top_companies = cluster_data.sort_values('total_pollution', ascending=False).head(5)
-                for _, row in top_companies.iterrows():
-                    f.write(f'  - {row["设置单位名称"]}: {row["total_pollution"]:.2f} 吨/年\n')
-                f.write('\n')
-        
-        # 生成可视化
-        self._generate_visualizations()
+                # 主要污染源分析
+                f.write('## 1. 主要污染源分析\n\n')
+                f.write('### 1.1 污染物排放量排名前10的企业\n\n')
+                company_stats.head(10).to_markdown(buf=f, index=False, floatfmt='.2f')
+                f.write('\n\n')
+                
+                # 空间聚类分析
+                f.write('## 2. 污染源空间分布分析\n\n')
+                cluster_info = self.data.groupby('cluster').agg({
+                    '设置单位名称': 'count',
+                    'total_pollution': 'sum'
+                }).reset_index()
+                
+                f.write('### 2.1 污染源聚集区统计\n\n')
+                cluster_info.to_markdown(buf=f, index=False, floatfmt='.2f')
+                f.write('\n\n')
+                
+                # 详细聚类信息
+                f.write('### 2.2 各聚集区详细信息\n\n')
+                for cluster_id, cluster_data in self._groups.items():
+                    if cluster_id == -1:  # 噪声点
+                        continue
+                        
+                    f.write(f'#### 聚集区 {cluster_id}\n\n')
+                    f.write(f'- 企业数量: {len(cluster_data)}\n')
+                    f.write(f'- 总污染物排放量: {cluster_data["total_pollution"].sum():.2f} 吨/年\n')
+                    f.write('- 主要企业:\n')
+                    
+                    # 按污染物排放量排序
+                    top_companies = cluster_data.sort_values('total_pollution', ascending=False).head(5)
+                    for name, total in top_companies[['设置单位名称', 'total_pollution']].itertuples(index=False, name=None):
+                        f.write(f'  - {name}: {total:.2f} 吨/年\n')
+                    f.write('\n')
+            
+            # 生成可视化
+            self._generate_visualizations()
+        finally:
+            # 出错时也等待并关闭进程池，避免工作进程残留
+            self._plotter.join()
         
         # 转换为Word文档
         self._convert_to_docx()
@@ -191,55 +208,55 @@ class PollutionTracer:
     def _generate_visualizations(self):
         """生成可视化图表"""
         # 1. 污染物排放量分布图
-        plt.figure(figsize=(12, 6))
-        self.data['total_pollution'].hist(bins=50)
-        plt.title('污染物排放量分布', fontsize=14)
-        plt.xlabel('排放量 (吨/年)', fontsize=12)
-        plt.ylabel('频数', fontsize=12)
-        plt.xticks(fontsize=10)
-        plt.yticks(fontsize=10)
-        plt.tight_layout()
-        plt.savefig(f'{self.output_dir}/pollution_distribution.png', dpi=300, bbox_inches='tight')
-        plt.close()
+        fig, ax = new_fig((12, 6))
+        ax.hist(self.data['total_pollution'].dropna(), bins=50)
+        ax.grid(True)
+        ax.set_title('污染物排放量分布', fontsize=14)
+        ax.set_xlabel('排放量 (吨/年)', fontsize=12)
+        ax.set_ylabel('频数', fontsize=12)
+        ax.tick_params(labelsize=10)
+        fig.tight_layout()
+        self._plotter.save(fig, f'{self.output_dir}/pollution_distribution.png', dpi=300, bbox_inches='tight')
         
         # 2. 空间聚类图
-        plt.figure(figsize=(12, 8))
-        for cluster_id in np.unique(self.data['cluster']):
-            if cluster_id == -1:
-                color = 'gray'
-                label = '噪声点'
-            else:
-                color = plt.cm.tab20(cluster_id % 20)
-                label = f'聚集区 {cluster_id}'
-            
-            cluster_data = self.data[self.data['cluster'] == cluster_id]
-            plt.scatter(cluster_data['经度'], cluster_data['纬度'], 
-                       c=[color], label=label, alpha=0.6)
+        fig, ax = new_fig((12, 8))
+        cmap = matplotlib.colormaps['tab20']
+        cluster_ids = self.data['cluster'].to_numpy()
+        lon = self.data['经度'].to_numpy(dtype=np.float64, na_value=np.nan)
+        lat = self.data['纬度'].to_numpy(dtype=np.float64, na_value=np.nan)
+        noise = cluster_ids == -1
+        
+        # 噪声点和聚集区各用一次scatter绘制，图例单独构造
+        ax.scatter(lon[noise], lat[noise], c='gray', alpha=0.6)
+        ax.scatter(lon[~noise], lat[~noise], c=cmap(cluster_ids[~noise] % 20), alpha=0.6)
+        handles = [Line2D([], [], marker='o', linestyle='', color='gray', alpha=0.6, label='噪声点')] if noise.any() else []
+        handles += [
+            Line2D([], [], marker='o', linestyle='', color=cmap(cluster_id % 20), alpha=0.6, label=f'聚集区 {cluster_id}')
+            for cluster_id in self._groups if cluster_id != -1
+        ]
         
-        plt.title('污染源空间分布', fontsize=14)
-        plt.xlabel('经度', fontsize=12)
-        plt.ylabel('纬度', fontsize=12)
-        plt.xticks(fontsize=10)
-        plt.yticks(fontsize=10)
-        plt.legend(fontsize=10)
-        plt.grid(True)
-        plt.tight_layout()
-        plt.savefig(f'{self.output_dir}/spatial_clusters.png', dpi=300, bbox_inches='tight')
-        plt.close()
+        ax.set_title('污染源空间分布', fontsize=14)
+        ax.set_xlabel('经度', fontsize=12)
+        ax.set_ylabel('纬度', fontsize=12)
+        ax.tick_params(labelsize=10)
+        ax.legend(handles=handles, fontsize=10)
+        ax.grid(True)
+        fig.tight_layout()
+        self._plotter.save(fig, f'{self.output_dir}/spatial_clusters.png', dpi=300, bbox_inches='tight')
         
         # 3. 生成交互式地图
         self._generate_interactive_map()
     
     def _generate_interactive_map(self):
         """生成交互式地图"""
-        m = folium.Map(location=[34, 111], zoom_start=7)
+        m = base_map()
+        centers = folium.FeatureGroup(name='聚集区中心')
         
         # 添加聚类标记
-        for cluster_id in np.unique(self.data['cluster']):
+        for cluster_id, cluster_data in self._groups.items():
             if cluster_id == -1:
                 continue
                 
-            cluster_data = self.data[self.data['cluster'] == cluster_id]
             center_lat = cluster_data['纬度'].mean()
             center_lon = cluster_data['经度'].mean()
             
@@ -251,17 +268,27 @@ class PollutionTracer:
                 fill=True,
                 fill_color='red',
                 popup=f'聚集区 {cluster_id}<br>企业数量: {len(cluster_data)}<br>总排放量: {cluster_data["total_pollution"].sum():.2f} 吨/年'
-            ).add_to(m)
-            
-            # 添加企业标记
-            for _, row in cluster_data.iterrows():
-                folium.Marker(
-                    location=[row['纬度'], row['经度']],
-                    popup=f"企业: {row['设置单位名称']}<br>排放量: {row['total_pollution']:.2f} 吨/年<br>类型: {row['排污口类型名称']}"
-                ).add_to(m)
+            ).add_to(centers)
+        centers.add_to(m)
+        
+        # 添加企业标记，所有聚集区企业作为一个GeoJSON图层在浏览器端渲染
+        companies = self.data[self.data['cluster'] != -1].assign(
+            total_pollution=lambda d: d['total_pollution'].astype(np.float64).round(2)
+        )
+        # 所有点都是噪声时没有要素，GeoJsonPopup无法渲染空的要素集合
+        if len(companies) > 0:
+            companies_layer = folium.FeatureGroup(name='聚集区企业')
+            fields = {'name': '设置单位名称', 'pollution': 'total_pollution', 'type': '排污口类型名称'}
+            folium.GeoJson(
+                points_geojson(companies, fields),
+                popup=folium.GeoJsonPopup(fields=list(fields), aliases=['企业', '排放量 (吨/年)', '类型'])
+            ).add_to(companies_layer)
+            companies_layer.add_to(m)
+        folium.LayerControl().add_to(m)
         
+        # 保存地图
         m.save(f'{self.output_dir}/pollution_map.html')
 
 if __name__ == '__main__':
     tracer = PollutionTracer('南水北调中线水源区排污口.xlsx')
-    tracer.generate_trace_report() 
\ No newline at end of file
+    tracer.generate_trace_report()